@@ -0,0 +1,146 @@
+import numpy as np
+from numba import njit, prange
+
+# Grid-hashed DBSCAN for 2D pixel coordinates. Points are binned into a spatial
+# hash with cell size eps, so each point only checks the 9 surrounding cells
+# instead of going through a ball tree; with the near-uniform densities of the
+# subpixel coordinates produced by the flow dynamics this is O(N).
+
+@njit('(float64[:,:], float64, int64, int64[:], int64[:], int64, int64)',
+      parallel=True, nogil=True, cache=True)
+def _core_points(points, eps, min_samples, order, starts, ncx, ncy):
+    N = points.shape[0]
+    eps2 = eps*eps
+    core = np.zeros(N, np.bool_)
+    xmin = points[:,0].min()
+    ymin = points[:,1].min()
+    inv = 1.0/eps
+    for i in prange(N):
+        cx = int((points[i,0]-xmin)*inv)
+        cy = int((points[i,1]-ymin)*inv)
+        cnt = 0
+        for dx in range(-1, 2):
+            if cx+dx < 0 or cx+dx >= ncx:
+                continue
+            for dy in range(-1, 2):
+                if cy+dy < 0 or cy+dy >= ncy:
+                    continue
+                cc = (cx+dx)*ncy + (cy+dy)
+                for k in range(starts[cc], starts[cc+1]):
+                    j = order[k]
+                    d2 = (points[i,0]-points[j,0])**2 + (points[i,1]-points[j,1])**2
+                    if d2 <= eps2:
+                        cnt += 1
+        core[i] = cnt >= min_samples
+    return core
+
+@njit('(float64[:,:], float64, boolean[:], int64[:], int64[:], int64, int64)',
+      nogil=True, cache=True)
+def _label_points(points, eps, core, order, starts, ncx, ncy):
+    N = points.shape[0]
+    eps2 = eps*eps
+    xmin = points[:,0].min()
+    ymin = points[:,1].min()
+    inv = 1.0/eps
+    # union-find over mutually reachable core points
+    parent = np.arange(N)
+    for i in range(N):
+        if not core[i]:
+            continue
+        cx = int((points[i,0]-xmin)*inv)
+        cy = int((points[i,1]-ymin)*inv)
+        for dx in range(-1, 2):
+            if cx+dx < 0 or cx+dx >= ncx:
+                continue
+            for dy in range(-1, 2):
+                if cy+dy < 0 or cy+dy >= ncy:
+                    continue
+                cc = (cx+dx)*ncy + (cy+dy)
+                for k in range(starts[cc], starts[cc+1]):
+                    j = order[k]
+                    if j <= i or not core[j]:
+                        continue
+                    d2 = (points[i,0]-points[j,0])**2 + (points[i,1]-points[j,1])**2
+                    if d2 <= eps2:
+                        ri = i
+                        while parent[ri] != ri:
+                            ri = parent[ri]
+                        rj = j
+                        while parent[rj] != rj:
+                            rj = parent[rj]
+                        if ri != rj:
+                            parent[max(ri, rj)] = min(ri, rj)
+    labels = -np.ones(N, np.int64)
+    labmap = -np.ones(N, np.int64)
+    nlab = 0
+    for i in range(N):
+        if core[i]:
+            r = i
+            while parent[r] != r:
+                r = parent[r]
+            if labmap[r] < 0:
+                labmap[r] = nlab
+                nlab += 1
+            labels[i] = labmap[r]
+    # border points join the cluster of their closest core neighbor
+    for i in range(N):
+        if core[i]:
+            continue
+        cx = int((points[i,0]-xmin)*inv)
+        cy = int((points[i,1]-ymin)*inv)
+        dbest = eps2
+        for dx in range(-1, 2):
+            if cx+dx < 0 or cx+dx >= ncx:
+                continue
+            for dy in range(-1, 2):
+                if cy+dy < 0 or cy+dy >= ncy:
+                    continue
+                cc = (cx+dx)*ncy + (cy+dy)
+                for k in range(starts[cc], starts[cc+1]):
+                    j = order[k]
+                    if not core[j]:
+                        continue
+                    d2 = (points[i,0]-points[j,0])**2 + (points[i,1]-points[j,1])**2
+                    if d2 <= dbest:
+                        dbest = d2
+                        labels[i] = labels[j]
+    return labels
+
+def dbscan_grid(points, eps, min_samples=3):
+    """ DBSCAN clustering of 2D points via a spatial hash of cell size eps
+
+    Parameters
+    -------------
+
+    points: float, 2D array [npoints x 2]
+        coordinates to cluster
+
+    eps: float
+        neighborhood radius (same meaning as sklearn DBSCAN)
+
+    min_samples: int (optional, default 3)
+        number of neighbors (point itself included) to count as a core point
+
+    Returns
+    -------------
+
+    labels: int64, 1D array
+        cluster label per point, -1 for noise (same convention as sklearn)
+
+    """
+    points = np.ascontiguousarray(points, np.float64)
+    N = points.shape[0]
+    if N == 0:
+        return -np.ones(0, np.int64)
+    inv = 1.0/eps
+    cx = ((points[:,0]-points[:,0].min())*inv).astype(np.int64)
+    cy = ((points[:,1]-points[:,1].min())*inv).astype(np.int64)
+    ncx, ncy = int(cx.max())+1, int(cy.max())+1
+    cellid = cx*ncy + cy
+    order = np.argsort(cellid, kind='stable')
+    # counting-sort offsets: O(N + ncells) instead of a binary search per cell
+    counts = np.bincount(cellid, minlength=ncx*ncy)
+    starts = np.zeros(ncx*ncy+1, np.int64)
+    np.cumsum(counts, out=starts[1:])
+    core = _core_points(points, float(eps), int(min_samples), order, starts, ncx, ncy)
+    return _label_points(points, float(eps), core, order, starts, ncx, ncy)
@@ -1,10 +1,9 @@
-import os, sys, time, shutil, tempfile, datetime, pathlib, subprocess
+import os, sys, time, shutil, tempfile, datetime, pathlib, subprocess, copy
 import logging
 import numpy as np
 from tqdm import trange, tqdm
 from urllib.parse import urlparse
 import tempfile
-from scipy.ndimage import median_filter
 import cv2
 from . import transforms, dynamics, utils, plot, metrics
 
@@ -133,6 +132,13 @@ class UnetModel():
         self.gpu = gpu if device is None else (self.device.type=='cuda')
         if torch and not self.gpu:
             self.mkldnn = check_mkl(self.torch)
+        # run the eval forward in half precision on GPU (tensor cores);
+        # outputs are cast back to float32 so downstream dynamics are unchanged
+        self.autocast = self.torch and self.gpu
+        # per-weight-file copies of the net for single-pass net averaging
+        self._ensemble_nets = None
+        self._ensemble_paths = None
+        self._use_ensemble = False
         self.pretrained_model = pretrained_model
         self.diam_mean = diam_mean
 
@@ -321,7 +327,13 @@ class UnetModel():
 
     def _to_device(self, x):
         if self.torch:
-            X = torch.from_numpy(x).float().to(self.device)
+            X = torch.from_numpy(x).float()
+            if self.gpu:
+                # stage through pinned memory so the H2D copy is DMA-driven and
+                # can overlap with the compute still queued on the default stream
+                X = X.pin_memory().to(self.device, non_blocking=True)
+            else:
+                X = X.to(self.device)
         else:
             #if x.dtype != 'bool':
             X = nd.array(x.astype(np.float32), ctx=self.device)
@@ -341,7 +353,20 @@ class UnetModel():
             self.net.eval()
             if self.mkldnn:
                 self.net = mkldnn_utils.to_mkldnn(self.net)
-        y, style = self.net(X)
+        if self.torch and self._use_ensemble:
+            # average the outputs of the loaded ensemble on-device, so tiling,
+            # transfers and stitching run once instead of once per network;
+            # the accumulation has to stay inside inference_mode because the
+            # forward outputs are inference tensors that cannot be updated
+            # in place outside it
+            with torch.inference_mode():
+                y, style = self._forward(self._ensemble_nets[0], X)
+                for net in self._ensemble_nets[1:]:
+                    y0, style = self._forward(net, X)
+                    y += y0
+                y /= len(self._ensemble_nets)
+        else:
+            y, style = self._forward(self.net, X)
         if self.mkldnn:
             self.net.to(torch_CPU)
         y = self._from_device(y)
@@ -349,10 +374,45 @@ class UnetModel():
         if return_conv:
             conv = self._from_device(conv)
             y = np.concatenate((y, conv), axis=1)
-        
+
         return y, style
-                
-    def _run_nets(self, img, net_avg=True, augment=False, tile=True, tile_overlap=0.1, bsize=224, 
+
+    def _forward(self, net, X):
+        """ run one network on device tensor X (no autograd, autocast on GPU) """
+        if not self.torch:
+            return net(X)
+        # inference_mode also skips view/version tracking that no_grad keeps
+        with torch.inference_mode():
+            if self.autocast:
+                with torch.cuda.amp.autocast(dtype=torch.float16):
+                    y, style = net(X)
+                return y.float(), style.float()
+            return net(X)
+
+    def _build_ensemble(self):
+        """ load each pretrained model into its own copy of the net,
+            so net-averaged evaluation can tile/transfer/stitch once and
+            average the outputs on-device; returns False if the net cannot
+            be copied (caller then falls back to sequential re-runs) """
+        if self._ensemble_paths == tuple(self.pretrained_model):
+            return True
+        try:
+            nets = []
+            for path in self.pretrained_model:
+                net = copy.deepcopy(self.net)
+                net.load_model(path, cpu=(not self.gpu))
+                net.eval()
+                nets.append(net)
+        except Exception:
+            core_logger.warning('could not copy network for ensemble averaging, falling back to sequential evaluation')
+            self._ensemble_nets = None
+            self._ensemble_paths = None
+            return False
+        self._ensemble_nets = nets
+        self._ensemble_paths = tuple(self.pretrained_model)
+        return True
+
+    def _run_nets(self, img, net_avg=True, augment=False, tile=True, tile_overlap=0.1, bsize=224,
                   return_conv=False, progress=None):
         """ run network (if more than one, loop over networks and average results
 
@@ -389,10 +449,21 @@ class UnetModel():
             but not averaged over networks.
 
         """
-        if isinstance(self.pretrained_model, str) or not net_avg:  
-            y, style = self._run_net(img, augment=augment, tile=tile, 
+        if isinstance(self.pretrained_model, str) or not net_avg:
+            y, style = self._run_net(img, augment=augment, tile=tile,
                                      bsize=bsize, return_conv=return_conv)
-        else:  
+        elif self.torch and self._build_ensemble():
+            # single pass over the tiles; network() averages the ensemble outputs
+            self._use_ensemble = True
+            try:
+                y, style = self._run_net(img, augment=augment, tile=tile,
+                                         tile_overlap=tile_overlap, bsize=bsize,
+                                         return_conv=return_conv)
+            finally:
+                self._use_ensemble = False
+            if progress is not None:
+                progress.setValue(50)
+        else:
             for j in range(len(self.pretrained_model)):
                 self.net.load_model(self.pretrained_model[j], cpu=(not self.gpu))
                 if not self.torch:
@@ -542,13 +613,17 @@ class UnetModel():
                 niter = int(np.ceil(Lz/nimgs))
                 ziterator = trange(niter, file=tqdm_out)
                 for k in ziterator:
-                    IMGa = np.zeros((ntiles*nimgs, nchan, ly, lx), np.float32)
-                    for i in range(min(Lz-k*nimgs, nimgs)):
-                        IMG, ysub, xsub, Ly, Lx = transforms.make_tiles(imgi[k*nimgs+i], bsize=bsize, 
+                    # only allocate and run the tiles of the images actually in
+                    # this chunk; the last chunk used to pad the batch with
+                    # zero tiles and run the net on them for nothing
+                    nim = min(Lz-k*nimgs, nimgs)
+                    IMGa = np.empty((ntiles*nim, nchan, ly, lx), np.float32)
+                    for i in range(nim):
+                        IMG, ysub, xsub, Ly, Lx = transforms.make_tiles(imgi[k*nimgs+i], bsize=bsize,
                                                                         augment=augment, tile_overlap=tile_overlap)
                         IMGa[i*ntiles:(i+1)*ntiles] = np.reshape(IMG, (ny*nx, nchan, ly, lx))
                     ya, stylea = self.network(IMGa)
-                    for i in range(min(Lz-k*nimgs, nimgs)):
+                    for i in range(nim):
                         y = ya[i*ntiles:(i+1)*ntiles]
                         if augment:
                             y = np.reshape(y, (ny, nx, 3, ly, lx))
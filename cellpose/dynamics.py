@@ -1,14 +1,12 @@
-import time, os
+import time, os, threading
 from scipy.ndimage.filters import maximum_filter1d
 from skimage import filters
-from scipy.ndimage.morphology import binary_dilation, binary_opening
 from skimage.measure import label, regionprops
 import torch
 import scipy.ndimage
 import numpy as np
-import tifffile
 from tqdm import trange
-from numba import njit, float32, int32, vectorize
+from numba import njit, prange, float32, int32, vectorize
 import edt
 from skimage import measure
 import fastremap
@@ -30,13 +28,87 @@ try:
 except:
     TORCH_ENABLED = False
 
-try:
-    from sklearn.cluster import DBSCAN
-    SKLEARN_ENABLED = True 
-except:
-    SKLEARN_ENABLED = False
-
-@njit('(float64[:], int32[:], int32[:], int32[:], int32[:], int32, int32, boolean)', nogil=True)
+# sklearn is only needed for the >2D DBSCAN fallback, so the import is
+# deferred to first use instead of slowing down every cellpose import
+SKLEARN_ENABLED = None
+
+def _sklearn_enabled():
+    global SKLEARN_ENABLED, DBSCAN
+    if SKLEARN_ENABLED is None:
+        try:
+            from sklearn.cluster import DBSCAN
+            SKLEARN_ENABLED = True
+        except:
+            SKLEARN_ENABLED = False
+    return SKLEARN_ENABLED
+
+from ._dbscan_nb import dbscan_grid
+
+# scratch buffers for the divergence stencil in compute_masks, reused across
+# calls on the same image shape; thread-local because models._run_cp runs
+# compute_masks on a thread pool. The output arrays (masks, p, flows) are
+# returned to callers and therefore cannot be pooled the same way.
+_local_bufs = threading.local()
+
+def _stencil_buffers(Ly, Lx):
+    cache = getattr(_local_bufs, 'stencil', None)
+    if cache is None:
+        cache = _local_bufs.stencil = {}
+    if len(cache) > 8:
+        cache.clear()
+    bufs = cache.get((Ly, Lx))
+    if bufs is None:
+        n = (Ly+2)*(Lx+2)
+        bufs = (np.empty(n, np.float32), np.empty(n, np.float32),
+                np.empty(Ly*Lx, np.float32))
+        cache[(Ly, Lx)] = bufs
+    for b in bufs:
+        b.fill(0)
+    return bufs
+
+def _flow_scratch(shape):
+    """ reusable float32 buffer for the rescaled flow passed to follow_flows """
+    cache = getattr(_local_bufs, 'flow', None)
+    if cache is None:
+        cache = _local_bufs.flow = {}
+    if len(cache) > 8:
+        cache.clear()
+    buf = cache.get(shape)
+    if buf is None:
+        buf = cache[shape] = np.empty(shape, np.float32)
+    return buf
+
+@njit('(float32[:], float32[:], float32[:], int64[:], int64)', parallel=True,
+      nogil=True, cache=True)
+def _div_stencil(Ty, Tx, div, flat, Lx):
+    """ fused 4th-order divergence at the masked pixels in flat, with the same
+        flat-index wrap semantics as the original Y*Lx+X gather version """
+    N = Ty.shape[0]
+    for k in prange(flat.shape[0]):
+        i = flat[k]
+        im1 = i - Lx
+        im2 = i - 2*Lx
+        jm1 = i - 1
+        jm2 = i - 2
+        if im1 < 0: im1 += N
+        if im2 < 0: im2 += N
+        if jm1 < 0: jm1 += N
+        if jm2 < 0: jm2 += N
+        div[i] = (Ty[i+2*Lx] + 8*Ty[i+Lx] - 8*Ty[im1] - Ty[im2] +
+                  Tx[i+2] + 8*Tx[i+1] - 8*Tx[jm1] - Tx[jm2])
+
+# cv2 versions of the scipy binary morphology used below; the SIMD kernels in
+# cv2 are several times faster on the image-sized masks these run on
+_cross_kernel = np.array([[0,1,0],[1,1,1],[0,1,0]], np.uint8)
+
+def _binary_opening(mask, iterations=1, border_value=0):
+    """ cv2 equivalent of scipy binary_opening with the default cross structure """
+    eroded = cv2.erode(mask.astype(np.uint8), _cross_kernel, iterations=iterations,
+                       borderType=cv2.BORDER_CONSTANT, borderValue=border_value)
+    return cv2.dilate(eroded, _cross_kernel, iterations=iterations,
+                      borderType=cv2.BORDER_CONSTANT, borderValue=border_value).astype(bool)
+
+@njit('(float64[:], int32[:], int32[:], int32[:], int32[:], int32, int32, boolean)', nogil=True, cache=True)
 def _extend_centers(T, y, x, ymed, xmed, Lx, niter, skel=False):
     """ run diffusion from center of mask (ymed, xmed) on mask pixels (y, x)
 
@@ -440,6 +512,7 @@ def labels_to_flows(labels, files=None, use_gpu=False, device=None, skel=False,r
             flows = [np.concatenate((labels[n][np.newaxis,:,:], labels[n][np.newaxis,:,:]>0.5, veci[n]), axis=0).astype(np.float32)
                     for n in range(nimg)]
         if files is not None:
+            import tifffile
             for flow, file in zip(flows, files):
                 file_name = os.path.splitext(file)[0]
                 tifffile.imsave(file_name+'_flows.tif', flow)
@@ -553,7 +626,7 @@ def steps2D_interp(p, dP, niter, use_gpu=False, device=None, skel=False, calc_tr
         return p, tr
 
 
-@njit('(float32[:,:,:,:],float32[:,:,:,:], int32[:,:], int32)', nogil=True)
+@njit('(float32[:,:,:,:],float32[:,:,:,:], int32[:,:], int32)', nogil=True, cache=True)
 def steps3D(p, dP, inds, niter):
     """ run dynamics of pixels to recover masks in 3D
     
@@ -594,7 +667,7 @@ def steps3D(p, dP, inds, niter):
             p[2,z,y,x] = min(shape[2]-1, max(0, p[2,z,y,x] + dP[2,p0,p1,p2]))
     return p, None
 
-@njit('(float32[:,:,:], float32[:,:,:], int32[:,:], int32, boolean, boolean)', nogil=True)
+@njit('(float32[:,:,:], float32[:,:,:], int32[:,:], int32, boolean, boolean)', nogil=True, cache=True)
 def steps2D(p, dP, inds, niter, skel=False, calc_trace=False):
     """ run dynamics of pixels to recover masks in 2D
     
@@ -712,7 +785,6 @@ def follow_flows(dP, mask=None, inds=None, niter=200, interp=True, use_gpu=True,
                                           device=device, skel=skel, calc_trace=calc_trace)
             
             p[:,inds[:,0],inds[:,1]] = p_interp
-    #print(p.shape)     
     return p, inds, tr #, p_interp
 
 def remove_bad_flow_masks(masks, flows, threshold=0.4, use_gpu=False, device=None, skel=False):
@@ -945,7 +1017,12 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, dist_threshol
             if verbose:
                 dynamics_logger.info('using original mask reconstruction algorithm')
             if p is None:
-                p , inds, tr = follow_flows(dP * mask / 5., mask=mask, inds=inds, niter=niter, interp=interp, 
+                # fused masking/rescale into a reused scratch buffer instead of
+                # allocating two image-sized temporaries (dP*mask then /5.)
+                dP5 = _flow_scratch(dP.shape)
+                np.multiply(dP, mask, out=dP5)
+                dP5 /= 5.
+                p , inds, tr = follow_flows(dP5, mask=mask, inds=inds, niter=niter, interp=interp,
                                             use_gpu=use_gpu, device=device, skel=skel, calc_trace=calc_trace)
             else: 
                 inds,tr = [],[]
@@ -983,16 +1060,14 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, dist_threshol
 
             # compute the divergence
             Y, X = np.nonzero(mask)
-            pad = 1
-            Tx = np.zeros((Ly+2*pad)*(Lx+2*pad), np.float64)
-            Tx[Y*Lx+X] = np.reshape(dP[1].copy(),Ly*Lx)[Y*Lx+X]
-            Ty = np.zeros((Ly+2*pad)*(Lx+2*pad), np.float64)
-            Ty[Y*Lx+X] = np.reshape(dP[0].copy(),Ly*Lx)[Y*Lx+X]
-
-            # Rescaling by the divergence
-            div = np.zeros(Ly*Lx, np.float64)
-            div[Y*Lx+X]=(Ty[(Y+2)*Lx+X]+8*Ty[(Y+1)*Lx+X]-8*Ty[(Y-1)*Lx+X]-Ty[(Y-2)*Lx+X]+
-                         Tx[Y*Lx+X+2]+8*Tx[Y*Lx+X+1]-8*Tx[Y*Lx+X-1]-Tx[Y*Lx+X-2])
+            flat = Y*Lx+X
+            Tx, Ty, div = _stencil_buffers(Ly, Lx)
+            Tx[flat] = dP[1].ravel()[flat]
+            Ty[flat] = dP[0].ravel()[flat]
+
+            # Rescaling by the divergence: one fused parallel gather over the
+            # masked pixels instead of eight full-buffer passes
+            _div_stencil(Ty, Tx, div, flat, Lx)
             div = transforms.normalize99(div,skel=True)
             div.shape = (Ly,Lx)
             #add sigmoid on boundary output to help push pixels away - the final bit needed in some cases!
@@ -1002,25 +1077,35 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, dist_threshol
 
             p, inds, tr = follow_flows(dP, mask, inds, interp=interp, use_gpu=use_gpu, device=device, skel=skel, calc_trace=calc_trace)
 
-            newinds = p[:,inds[:,0],inds[:,1]].swapaxes(0,1)
+            # contiguous copy up front: the clustering / rounding below read the
+            # coordinate columns sequentially, which strides badly on the
+            # transposed view and forces silent copies downstream
+            newinds = np.ascontiguousarray(p[:,inds[:,0],inds[:,1]].T)
             mask = np.zeros((p.shape[1],p.shape[2]))
 
             # the eps parameter needs to be adjustable... maybe a function of the distance
-            if cluster and SKLEARN_ENABLED:
+            if cluster and (newinds.shape[1]==2 or _sklearn_enabled()):
                 if verbose:
                     dynamics_logger.info('Doing DBSCAN clustering with eps=%f'%eps)
-                db = DBSCAN(eps=eps, min_samples=3,n_jobs=8).fit(newinds)
-                labels = db.labels_
+                if newinds.shape[1]==2:
+                    # grid-hashed numba DBSCAN, much faster than sklearn in 2D
+                    labels = dbscan_grid(newinds, eps, min_samples=3)
+                else:
+                    db = DBSCAN(eps=eps, min_samples=3,n_jobs=8).fit(newinds)
+                    labels = db.labels_
                 mask[inds[:,0],inds[:,1]] = labels+1
             else:
                 newinds = np.rint(newinds).astype(int)
                 skelmask = np.zeros_like(dist, dtype=bool)
                 skelmask[newinds[:,0],newinds[:,1]] = 1
 
-                #disconnect skeletons at the edge, 5 pixels in 
+                #disconnect skeletons at the edge, 5 pixels in
                 border_mask = np.zeros(skelmask.shape, dtype=bool)
                 border_px =  border_mask.copy()
-                border_mask = binary_dilation(border_mask, border_value=1, iterations=5)
+                # the border-seeded dilation is just a 5-pixel frame; write it
+                # directly instead of iterating a morphology kernel 5 times
+                border_mask[:5] = border_mask[-5:] = True
+                border_mask[:,:5] = border_mask[:,-5:] = True
 
                 border_px[border_mask] = skelmask[border_mask]
                 if nclasses == 4: #can use boundary to erase joined edge skelmasks 
@@ -1028,7 +1113,7 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, dist_threshol
                     if verbose:
                         dynamics_logger.info('Using boundary output to split edge defects')
                 else: #otherwise do morphological opening to attempt splitting 
-                    border_px = binary_opening(border_px,border_value=0,iterations=3)
+                    border_px = _binary_opening(border_px, border_value=0, iterations=3)
 
                 skelmask[border_mask] = border_px[border_mask]
 
@@ -1044,10 +1129,9 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, dist_threshol
                 dynamics_logger.info(f'resizing output with resize = {resize}')
             mask = transforms.resize_image(mask, resize[0], resize[1], interpolation=cv2.INTER_NEAREST)
             Ly,Lx = mask.shape
-            pi = np.zeros([2,Ly,Lx])
-            for k in range(2):
-                pi[k] = cv2.resize(p[k], (Lx, Ly), interpolation=cv2.INTER_NEAREST)
-            p = pi       
+            # resize both flow coordinate planes in one cv2 call (HxWxC layout)
+            p_hwc = np.ascontiguousarray(np.moveaxis(p, 0, -1), np.float32)
+            p = np.moveaxis(cv2.resize(p_hwc, (Lx, Ly), interpolation=cv2.INTER_NEAREST), -1, 0)
     else: # nothing to compute, just make it compatible
         dynamics_logger.info('No cell pixels found.')
         p = np.zeros([2,1,1])
@@ -1058,5 +1142,12 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, dist_threshol
     # maybe better would be to rescale the min_size and hole_size parameters to do the
     # cleanup at the prediction scale, or switch depending on which one is bigger... 
     mask = utils.fill_holes_and_remove_small_masks(mask, min_size=min_size)
-    fastremap.renumber(mask,in_place=True) #convenient to guarantee non-skipped labels
+    # renumber only when labels are not already dense 1..K (i.e. small masks
+    # were removed above); label() outputs are dense so this usually skips the
+    # extra remap pass while still guaranteeing non-skipped labels
+    mx = int(mask.max()) if mask.size > 0 else 0
+    if mx > 0:
+        nlab = np.count_nonzero(np.bincount(mask.ravel().astype(np.int64, copy=False), minlength=mx+1)[1:])
+        if nlab != mx:
+            fastremap.renumber(mask,in_place=True)
     return mask, p, tr
\ No newline at end of file
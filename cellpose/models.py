@@ -1,7 +1,12 @@
-import os, sys, time, shutil, tempfile, datetime, pathlib, subprocess
+import os, sys, time, shutil, tempfile, datetime, pathlib, subprocess, math
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from tqdm import trange, tqdm
 from urllib.parse import urlparse
+from numba import njit, prange
+from scipy.linalg.blas import ssyrk
+from scipy.linalg.lapack import sposv
 import torch
 
 import logging
@@ -26,10 +31,13 @@ def size_model_path(model_type, use_torch):
     basename = 'size_%s%s_0.npy' % (model_type, torch_str)
     return cache_model_path(basename)
 
+# memoized so repeated model instantiations skip the mkdir/stat syscalls
+# (downloads are only checked for the first time each file is requested)
+@functools.lru_cache(maxsize=None)
 def cache_model_path(basename):
     MODEL_DIR.mkdir(parents=True, exist_ok=True)
     url = f'{_MODEL_URL}/{basename}'
-    cached_file = os.fspath(MODEL_DIR.joinpath(basename)) 
+    cached_file = os.fspath(MODEL_DIR.joinpath(basename))
     if not os.path.exists(cached_file):
         models_logger.info('Downloading: "{}" to {}\n'.format(url, cached_file))
         utils.download_url_to_file(url, cached_file, progress=True)
@@ -75,8 +83,13 @@ class Cellpose():
         
         self.skel = skel        
         
-        self.pretrained_model = [model_path(model_type, j, torch) for j in range(4)]
-        self.pretrained_size = size_model_path(model_type, torch)
+        # fetch the 4 network weight files and the size model concurrently so
+        # cold-start downloads overlap; free when the files are already cached
+        with ThreadPoolExecutor(max_workers=5) as pool:
+            model_futures = [pool.submit(model_path, model_type, j, torch) for j in range(4)]
+            size_future = pool.submit(size_model_path, model_type, torch)
+            self.pretrained_model = [f.result() for f in model_futures]
+            self.pretrained_size = size_future.result()
         self.diam_mean = 30. if model_type!='nuclei' else 17.
         
         if not net_avg:
@@ -199,12 +212,12 @@ class Cellpose():
             models_logger.info('~~~ ESTIMATING CELL DIAMETER(S) ~~~')
             diams, _ = self.sz.eval(x, channels=channels, channel_axis=channel_axis, invert=invert, batch_size=batch_size, 
                                     augment=augment, tile=tile, normalize=normalize)
-            rescale = self.diam_mean / np.array(diams)
+            rescale = self.diam_mean / np.asarray(diams, np.float32)
             diameter = None
             models_logger.info('estimated cell diameter(s) in %0.2f sec'%(time.time()-tic))
             models_logger.info('>>> diameter(s) = ')
             if isinstance(diams, list) or isinstance(diams, np.ndarray):
-                diam_string = '[' + ''.join(['%0.2f, '%d for d in diams]) + ']'
+                diam_string = np.array2string(np.asarray(diams), precision=2, separator=', ')
             else:
                 diam_string = '[ %0.2f ]'%diams
             models_logger.info(diam_string)
@@ -334,14 +347,37 @@ class CellposeModel(UnetModel):
                          nclasses=nclasses, torch=torch, nchan=nchan)
 
         self.unet = False
+        # torch.cuda.empty_cache() synchronizes and hands cached blocks back to the
+        # driver, so the next eval has to re-allocate them; only release the cache
+        # every N evals (CELLPOSE_EMPTY_CACHE_EVERY, off by default) or when the
+        # allocator gets close to the total device memory
+        self._empty_cache_every = int(os.environ.get('CELLPOSE_EMPTY_CACHE_EVERY', 0))
+        self._eval_count = 0
+        # per-shape plans for _run_cp so repeated same-shape evals skip the
+        # output-geometry computation (see _cp_plan)
+        self._cp_cache = {}
+        # opt-in float16 storage for the flow/probability buffers in _run_cp;
+        # halves the memory of large stacks, mask math still runs in float32
+        self.low_precision = False
         self.pretrained_model = pretrained_model
         if self.pretrained_model and len(self.pretrained_model)==1:
             self.net.load_model(self.pretrained_model[0], cpu=(not self.gpu))
+            if self.torch:
+                self.net.eval()
         ostr = ['off', 'on']
         self.net_type = 'cellpose_residual_{}_style_{}_concatenation_{}'.format(ostr[residual_on],
                                                                                 ostr[style_on],
                                                                                 ostr[concatenation])
-    
+        if self.torch and self.gpu and hasattr(torch, 'compile'):
+            # compile the network once at load time; kernel fusion and graph capture
+            # cut the per-forward Python and launch overhead on GPU
+            # (load_model still reaches the underlying module through the wrapper,
+            # so the net-averaging path keeps working)
+            try:
+                self.net = torch.compile(self.net, mode='reduce-overhead', fullgraph=False)
+            except Exception:
+                models_logger.warning('torch.compile failed, running eager-mode network')
+
     def eval(self, x, batch_size=8, channels=None, channel_axis=None, 
              z_axis=None, normalize=True, invert=False, 
              rescale=None, diameter=None, do_3D=False, anisotropy=None, net_avg=True, 
@@ -456,6 +492,39 @@ class CellposeModel(UnetModel):
             masks, styles, flows = [], [], []
             tqdm_out = utils.TqdmToLogger(models_logger, level=logging.INFO)
             nimg = len(x)
+            # if all images share the same shape (and no per-image parameters are given),
+            # stack them and run the network in one pass instead of recursing per image;
+            # this loads the weights once and shares the tile batches across images
+            if (isinstance(x, list) and nimg > 1 and not do_3D and stitch_threshold==0 and
+                    z_axis is None and
+                    all(isinstance(xi, np.ndarray) and xi.shape==x[0].shape for xi in x) and
+                    (x[0].ndim==2 or (x[0].ndim==3 and min(x[0].shape)<=3) or channel_axis is not None) and
+                    not isinstance(rescale, (list, np.ndarray)) and
+                    not isinstance(diameter, (list, np.ndarray)) and
+                    (channels is None or not isinstance(channels[0], (list, np.ndarray)))):
+                return self._eval_batched(x,
+                                          batch_size=batch_size,
+                                          channels=channels,
+                                          channel_axis=channel_axis,
+                                          normalize=normalize,
+                                          invert=invert,
+                                          rescale=rescale,
+                                          diameter=diameter,
+                                          net_avg=net_avg,
+                                          augment=augment,
+                                          tile=tile,
+                                          tile_overlap=tile_overlap,
+                                          resample=resample,
+                                          interp=interp,
+                                          cluster=cluster,
+                                          flow_threshold=flow_threshold,
+                                          dist_threshold=dist_threshold,
+                                          diam_threshold=diam_threshold,
+                                          compute_masks=compute_masks,
+                                          min_size=min_size,
+                                          skel=skel,
+                                          calc_trace=calc_trace,
+                                          verbose=verbose)
             iterator = trange(nimg, file=tqdm_out) if nimg>1 else range(nimg)
             for i in iterator:
                 maski, stylei, flowi = self.eval(x[i], 
@@ -530,10 +599,97 @@ class CellposeModel(UnetModel):
                                                           calc_trace=calc_trace,
                                                           verbose=verbose)
             flows = [plot.dx_to_circ(dP), dP, dist, p, bd, tr]
-            
-            torch.cuda.empty_cache() #attempt to clear memory
+
+            self._maybe_empty_cache()
             return masks, flows, styles
 
+    def _maybe_empty_cache(self):
+        """ release cached GPU memory only when asked to or when nearly full,
+            keeping the caching allocator warm across back-to-back evals """
+        if not (self.torch and self.gpu):
+            return
+        self._eval_count += 1
+        if self._empty_cache_every > 0:
+            if self._eval_count % self._empty_cache_every == 0:
+                torch.cuda.empty_cache()
+        elif (torch.cuda.memory_reserved(self.device) >
+              0.9 * torch.cuda.get_device_properties(self.device).total_memory):
+            torch.cuda.empty_cache()
+
+    def _eval_batched(self, x, batch_size=8, channels=None, channel_axis=None,
+                      normalize=True, invert=False, rescale=None, diameter=None,
+                      net_avg=True, augment=False, tile=True, tile_overlap=0.1,
+                      resample=False, interp=True, cluster=False,
+                      flow_threshold=0.4, dist_threshold=0.0, diam_threshold=12.,
+                      compute_masks=True, min_size=15, skel=False,
+                      calc_trace=False, verbose=False):
+        """ segment a list of same-sized 2D images in a single network pass
+
+            images are stacked into one [nimg x Ly x Lx x nchan] array so the
+            network weights are loaded once and all images share the preallocated
+            output buffers in _run_cp; outputs are split back into per-image lists
+            (same format as the per-image recursion in eval)
+
+        """
+        x = np.stack([transforms.convert_image(xi, channels, channel_axis=channel_axis, z_axis=None,
+                                               do_3D=False, normalize=False, invert=False,
+                                               nchan=self.nchan, skel=skel) for xi in x])
+        nimg = x.shape[0]
+        self.batch_size = batch_size
+        rescale = self.diam_mean / diameter if (rescale is None and (diameter is not None and diameter>0)) else rescale
+        rescale = 1.0 if rescale is None else rescale
+
+        if isinstance(self.pretrained_model, list) and not net_avg:
+            self.net.load_model(self.pretrained_model[0], cpu=(not self.gpu))
+            if not self.torch:
+                self.net.collect_params().grad_req = 'null'
+
+        masks, styles, dP, dist, p, bd, tr = self._run_cp(x,
+                                                          compute_masks=compute_masks,
+                                                          normalize=normalize,
+                                                          invert=invert,
+                                                          rescale=rescale,
+                                                          net_avg=net_avg,
+                                                          resample=resample,
+                                                          augment=augment,
+                                                          tile=tile,
+                                                          tile_overlap=tile_overlap,
+                                                          dist_threshold=dist_threshold,
+                                                          diam_threshold=diam_threshold,
+                                                          flow_threshold=flow_threshold,
+                                                          interp=interp,
+                                                          cluster=cluster,
+                                                          min_size=min_size,
+                                                          skel=skel,
+                                                          calc_trace=calc_trace,
+                                                          verbose=verbose)
+        masks_list, flows_list, styles_list = [], [], []
+        for i in range(nimg):
+            if compute_masks:
+                maski, pi, tri = masks[i], p[:,i], tr[i]
+            else:
+                maski, pi, tri = np.zeros(0), np.zeros(0), np.zeros(0)
+            masks_list.append(maski)
+            flows_list.append([plot.dx_to_circ(dP[:,i]), dP[:,i], dist[i], pi, bd[i], tri])
+            styles_list.append(styles[i])
+
+        self._maybe_empty_cache()
+        return masks_list, flows_list, styles_list
+
+    def _cp_plan(self, shape, rescale, resample):
+        """ cached output geometry for _run_cp, keyed on the invariant
+            arguments so hundreds of same-shape evals hit the dict instead
+            of recomputing the rescaled sizes each call """
+        key = (shape, rescale, resample)
+        plan = self._cp_cache.get(key)
+        if plan is None:
+            if resample:
+                plan = (shape[1], shape[2])
+            else:
+                plan = (int(shape[1]*rescale), int(shape[2]*rescale))
+            self._cp_cache[key] = plan
+        return plan
+
     def _run_cp(self, x, compute_masks=True, normalize=True, invert=False,
                 rescale=1.0, net_avg=True, resample=False,
                 augment=False, tile=True, tile_overlap=0.1,
@@ -547,13 +703,25 @@ class CellposeModel(UnetModel):
         if do_3D:
             img = np.asarray(x)
             if normalize or invert:
-                img = transforms.normalize_img(img, invert=invert, skel=skel)
+                if self.torch and self.gpu:
+                    # normalize volume-sized stacks on the GPU; the percentile
+                    # sorts dominate on CPU for GB-scale 3D inputs
+                    img_t = torch.from_numpy(img.astype(np.float32)).to(self.device)
+                    img = transforms.normalize_img_torch(img_t, invert=invert, skel=skel).cpu().numpy()
+                else:
+                    img = transforms.normalize_img(img, invert=invert, skel=skel)
             yf, styles = self._run_3D(img, rsz=rescale, anisotropy=anisotropy, 
                                       net_avg=net_avg, augment=augment, tile=tile,
                                       tile_overlap=tile_overlap)
-            dist = yf[0][-1] + yf[1][-1] + yf[2][-1] # changed in name only, no edits to 3D yet
-            dP = np.stack((yf[1][0] + yf[2][0], yf[0][0] + yf[2][1], yf[0][1] + yf[1][1]),
-                          axis=0) # (dZ, dY, dX)
+            # changed in name only, no edits to 3D yet; sums go into preallocated
+            # buffers so no volume-sized temporaries are created
+            dist = np.empty_like(yf[0][-1])
+            np.add(yf[0][-1], yf[1][-1], out=dist)
+            dist += yf[2][-1]
+            dP = np.empty((3,) + dist.shape, yf.dtype) # (dZ, dY, dX)
+            np.add(yf[1][0], yf[2][0], out=dP[0])
+            np.add(yf[0][0], yf[2][1], out=dP[1])
+            np.add(yf[0][1], yf[1][1], out=dP[2])
             
             # just for compatibility below for now
             bd = np.zeros_like(dist)
@@ -561,35 +729,80 @@ class CellposeModel(UnetModel):
         else:
             tqdm_out = utils.TqdmToLogger(models_logger, level=logging.INFO)
             iterator = trange(nimg, file=tqdm_out) if nimg>1 else range(nimg)
-            styles = np.zeros((nimg, self.nbase[-1]), np.float32)
-            if resample:
-                dP = np.zeros((2, nimg, shape[1], shape[2]), np.float32)
-                dist = np.zeros((nimg, shape[1], shape[2]), np.float32)
-                bd = np.zeros_like(dist)
+            Lyr, Lxr = self._cp_plan(shape, rescale, resample)
+            styles = np.empty((nimg, self.nbase[-1]), np.float32)
+            # dP, dist and styles are fully overwritten in the loop below so
+            # np.empty skips the zero-fill; bd is only written for nclasses==4
+            ftype = np.float16 if getattr(self, 'low_precision', False) else np.float32
+            dP = np.empty((2, nimg, Lyr, Lxr), ftype)
+            dist = np.empty((nimg, Lyr, Lxr), ftype)
+            bd = np.zeros_like(dist)
+
+            if (normalize or invert) and nimg > 1:
+                # batch the percentile computation: one vectorized call over the
+                # whole stack instead of per-image, per-channel partial sorts
+                xs = np.asarray(x)
+                plow, phigh = (0.01, 99.99) if skel else (1, 99)
+                axes = tuple(range(1, xs.ndim-1))
+                lows = np.percentile(xs, plow, axis=axes)
+                highs = np.percentile(xs, phigh, axis=axes)
             else:
-                dP = np.zeros((2, nimg, int(shape[1]*rescale), int(shape[2]*rescale)), np.float32)
-                dist = np.zeros((nimg, int(shape[1]*rescale), int(shape[2]*rescale)), np.float32)
-                bd = np.zeros_like(dist)
-                
-            for i in iterator:
+                lows = highs = None
+
+            def _prep(i):
                 img = np.asarray(x[i])
                 if normalize or invert:
-                    img = transforms.normalize_img(img, invert=invert, skel=skel)
+                    img = transforms.normalize_img(img, invert=invert, skel=skel,
+                                                   percentiles=None if lows is None else (lows[i], highs[i]))
                 if rescale != 1.0:
                     img = transforms.resize_image(img, rsz=rescale)
+                return img
+
+            # when several same-shape images are tiled, batch the tile grids of
+            # all images through the network in one _run_nets call (the 4D
+            # stack path) instead of one call per image; the augment reshape in
+            # that path assumes 3 output maps so it keeps the per-image loop
+            batched_net = nimg > 1 and tile and not augment
+            if batched_net:
+                yf_all, style_all = self._run_nets(np.stack([_prep(i) for i in range(nimg)]),
+                                                   net_avg=net_avg,
+                                                   augment=augment, tile=tile,
+                                                   tile_overlap=tile_overlap)
+
+            # in the per-image path, preprocess the next image on a worker
+            # thread while the current one is in the network
+            prefetch = None
+            if not batched_net and nimg > 1:
+                prefetch = ThreadPoolExecutor(max_workers=1)
+                prepped = prefetch.submit(_prep, 0)
 
-                yf, style = self._run_nets(img, net_avg=net_avg,
-                                           augment=augment, tile=tile,
-                                           tile_overlap=tile_overlap)
+            for i in iterator:
+                if batched_net:
+                    yf = yf_all[i]
+                    style = style_all[i] / ((style_all[i]**2).sum()**0.5)
+                else:
+                    if prefetch is not None:
+                        img = prepped.result()
+                        if i+1 < nimg:
+                            prepped = prefetch.submit(_prep, i+1)
+                    else:
+                        img = _prep(i)
+
+                    yf, style = self._run_nets(img, net_avg=net_avg,
+                                               augment=augment, tile=tile,
+                                               tile_overlap=tile_overlap)
                 if resample:
                     yf = transforms.resize_image(yf, shape[1], shape[2])
 
                 dist[i] = yf[:,:,2]
-                dP[:, i] = yf[:,:,:2].transpose((2,0,1)) 
+                dP[:, i] = yf[:,:,:2].transpose((2,0,1))
                 if self.nclasses == 4:
                     bd[i] = yf[:,:,3]
                 styles[i] = style
-        
+
+            if prefetch is not None:
+                prefetch.shutdown(wait=False)
+
         net_time = time.time() - tic
         if nimg > 1:
             models_logger.info('network run in %2.2fs'%(net_time))
@@ -604,25 +817,40 @@ class CellposeModel(UnetModel):
                                                       resize=None, skel=skel, calc_trace=calc_trace, verbose=verbose,
                                                       use_gpu=self.gpu, device=self.device, nclasses=self.nclasses)
             else:
-                masks = np.zeros((nimg, shape[1], shape[2]), np.uint16)
-                p = np.zeros((2, nimg, shape[1], shape[2]) if not resample else dP.shape, np.uint16)
-#                 p = np.zeros(dP.shape, np.uint16)
+                # every slice of masks and p is assigned in the loop below
+                masks = np.empty((nimg, shape[1], shape[2]), np.uint16)
+                p = np.empty((2, nimg, shape[1], shape[2]) if not resample else dP.shape, np.uint16)
 
-                tr = [[]]*nimg # trace may not work correctly with multiple images currently, still need to test it 
+                tr = [[]]*nimg # trace may not work correctly with multiple images currently, still need to test it
                 resize = [shape[1], shape[2]] if not resample else None
-                for i in iterator:
-                    masks[i], p[:,i], tr[i] = dynamics.compute_masks(dP[:,i], dist[i], bd[i], 
-                                                                     niter=niter, 
-                                                                     dist_threshold=dist_threshold,
-                                                                     flow_threshold=flow_threshold, 
-                                                                     diam_threshold=diam_threshold, 
-                                                                     interp=interp, cluster=cluster,
-                                                                     resize=resize, 
-                                                                     skel=skel, calc_trace=calc_trace, 
-                                                                     verbose=verbose,
-                                                                     use_gpu=self.gpu, 
-                                                                     device=self.device, 
-                                                                     nclasses=self.nclasses)
+                def _masks_i(i):
+                    # single upcast per image when buffers are stored float16;
+                    # no copy in the default float32 configuration
+                    return dynamics.compute_masks(np.asarray(dP[:,i], np.float32),
+                                                  np.asarray(dist[i], np.float32),
+                                                  np.asarray(bd[i], np.float32),
+                                                  niter=niter,
+                                                  dist_threshold=dist_threshold,
+                                                  flow_threshold=flow_threshold,
+                                                  diam_threshold=diam_threshold,
+                                                  interp=interp, cluster=cluster,
+                                                  resize=resize,
+                                                  skel=skel, calc_trace=calc_trace,
+                                                  verbose=verbose,
+                                                  use_gpu=self.gpu,
+                                                  device=self.device,
+                                                  nclasses=self.nclasses)
+                if nimg > 1 and not self.gpu:
+                    # mask reconstruction is independent per image and its heavy
+                    # parts (numba nogil kernels, cv2, fastremap) release the
+                    # GIL, so run the images on a thread pool; GPU runs keep the
+                    # sequential loop so follow_flows device use stays serialized
+                    with ThreadPoolExecutor(min(nimg, os.cpu_count() or 1)) as pool:
+                        for i, out in enumerate(pool.map(_masks_i, range(nimg))):
+                            masks[i], p[:,i], tr[i] = out
+                else:
+                    for i in iterator:
+                        masks[i], p[:,i], tr[i] = _masks_i(i)
             
                 if stitch_threshold > 0 and nimg > 1:
                     models_logger.info(f'stitching {nimg} planes using stitch_threshold={stitch_threshold:0.3f} to make 3D masks')
@@ -771,6 +999,24 @@ class CellposeModel(UnetModel):
         self.pretrained_model = model_path
         return model_path
 
+def _corr(a, b):
+    """ Pearson correlation of two 1D arrays, skipping the 2x2 corrcoef matrix """
+    a = a - a.mean()
+    b = b - b.mean()
+    return float(a @ b / math.sqrt((a @ a) * (b @ b)))
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _size_pred(A, S, bias):
+    """ fused exp(A @ S.T + bias) clipped below at 5., one pass over S """
+    n = S.shape[0]
+    out = np.empty(n, np.float32)
+    for i in prange(n):
+        d = np.float32(0.)
+        for j in range(A.shape[0]):
+            d += A[j] * S[i,j]
+        out[i] = max(np.float32(5.), np.exp(d + bias))
+    return out
+
 class SizeModel():
     """ linear regression model for determining the size of objects in image
         used to rescale before input to cp_model
@@ -802,7 +1048,15 @@ class SizeModel():
         self.diam_mean = self.cp.diam_mean
         self.torch = self.cp.torch
         if pretrained_size is not None:
-            self.params = np.load(self.pretrained_size, allow_pickle=True).item()
+            dat = np.load(self.pretrained_size, allow_pickle=True)
+            if isinstance(dat, np.lib.npyio.NpzFile):
+                self.params = {k: dat[k] for k in dat.files}
+                self.params['diam_mean'] = float(self.params['diam_mean'])
+                self.params['ymean'] = float(self.params['ymean'])
+                dat.close()
+            else:
+                # downloaded size models are pickled dicts in a .npy
+                self.params = dat.item()
             self.diam_mean = self.params['diam_mean']
         if not hasattr(self.cp, 'pretrained_model'):
             error_message = 'no pretrained cellpose model specified, cannot compute size'
@@ -936,9 +1190,10 @@ class SizeModel():
             therefore a conversion factor is included (to be removed)
         
         """
-        szest = np.exp(self.params['A'] @ (style - self.params['smean']).T +
-                        np.log(self.diam_mean) + self.params['ymean'])
-        szest = np.maximum(5., szest)
+        szest = np.asarray(self.params['A'] @ (style - self.params['smean']).T)
+        szest += np.log(self.diam_mean) + self.params['ymean']
+        np.exp(szest, out=szest)
+        np.maximum(szest, 5., out=szest)
         return szest
 
     def train(self, train_data, train_labels,
@@ -989,63 +1244,126 @@ class SizeModel():
         else:
             cp_model_path = self.cp.pretrained_model
         
-        diam_train = np.array([utils.diameters(lbl,skel=skel)[0] for lbl in train_labels])
-        if run_test: 
-            diam_test = np.array([utils.diameters(lbl,skel=skel)[0] for lbl in test_labels])
+        # diameters are independent per label image and mostly numpy/numba work
+        # that releases the GIL, so compute them on a thread pool
+        with ThreadPoolExecutor(min(len(train_labels), os.cpu_count() or 1)) as pool:
+            diam_train = np.array(list(pool.map(lambda lbl: utils.diameters(lbl,skel=skel)[0], train_labels)))
+            if run_test:
+                diam_test = np.array(list(pool.map(lambda lbl: utils.diameters(lbl,skel=skel)[0], test_labels)))
         
-        # remove images with no masks
-        for i in range(len(diam_train)):
-            if diam_train[i]==0.0:
-                del train_data[i]
-                del train_labels[i]
+        # remove images with no masks: one vectorized mask pass instead of the
+        # index-shifting del loop, which skipped the entry after each deletion
+        # and left diam_train misaligned with the filtered lists
+        keep = diam_train != 0.0
+        train_data = [d for d, k in zip(train_data, keep) if k]
+        train_labels = [l for l, k in zip(train_labels, keep) if k]
+        diam_train = diam_train[keep]
         if run_test:
-            for i in range(len(diam_test)):
-                if diam_test[i]==0.0:
-                    del test_data[i]
-                    del test_labels[i]
+            keep = diam_test != 0.0
+            test_data = [d for d, k in zip(test_data, keep) if k]
+            test_labels = [l for l, k in zip(test_labels, keep) if k]
+            diam_test = diam_test[keep]
 
         nimg = len(train_data)
-        styles = np.zeros((n_epochs*nimg, 256), np.float32)
-        diams = np.zeros((n_epochs*nimg,), np.float32)
+        # every row is filled by the batch loop below, so skip the zeroing
+        styles = np.empty((n_epochs*nimg, 256), np.float32)
+        diams = np.empty((n_epochs*nimg,), np.float32)
         tic = time.time()
+        # hoist the per-batch log computations: diam_train and diam_mean are
+        # fixed across batches, only the augmentation scale changes
+        log_diam_train = np.log(diam_train) - np.log(self.diam_mean)
         for iepoch in range(n_epochs):
             iall = np.arange(0,nimg,1,int)
             for ibatch in range(0,nimg,batch_size):
                 inds = iall[ibatch:ibatch+batch_size]
                 #using the orignal rotate and resize just because mine apparently broke the feature that
-                # you could either pass in flows or masks... will eventually fix and streamline 
+                # you could either pass in flows or masks... will eventually fix and streamline
                 imgi,lbl,scale = transforms.original_random_rotate_and_resize([train_data[i] for i in inds],
-                                                                              Y=[train_labels[i].astype(np.int16) for i in inds], 
-                                                                              scale_range=1, xy=(512,512)) 
+                                                                              Y=[train_labels[i].astype(np.int16) for i in inds],
+                                                                              scale_range=1, xy=(512,512))
 
                 feat = self.cp.network(imgi)[1]
                 styles[inds+nimg*iepoch] = feat
-                diams[inds+nimg*iepoch] = np.log(diam_train[inds]) - np.log(self.diam_mean) + np.log(scale)
+                diams[inds+nimg*iepoch] = log_diam_train[inds] + np.log(scale)
             del feat
             if (iepoch+1)%2==0:
                 models_logger.info('ran %d epochs in %0.3f sec'%(iepoch+1, time.time()-tic))
 
         # create model
         smean = styles.mean(axis=0)
-        X = ((styles - smean).T).copy()
+        # center in place: the raw styles are not needed again, so this saves
+        # an (n_epochs*nimg) x 256 temporary
+        styles -= smean
+        S = styles
         ymean = diams.mean()
         y = diams - ymean
 
-        A = np.linalg.solve(X@X.T + l2_regularization*np.eye(X.shape[0]), X @ y)
-        ypred = A @ X
-        models_logger.info('train correlation: %0.4f'%np.corrcoef(y, ypred)[0,1])
-            
+        if self.torch and self.cp.gpu:
+            # the styles came off the GPU anyway, so solve there too: cuBLAS
+            # handles the Gram matrix and cuSOLVER the Cholesky factor,
+            # skipping the round-trip to CPU LAPACK
+            S_t = torch.from_numpy(S).to(self.device)
+            y_t = torch.from_numpy(y).to(self.device)
+            G_t = S_t.T @ S_t
+            G_t.diagonal().add_(l2_regularization)
+            L = torch.linalg.cholesky(G_t)
+            A = torch.cholesky_solve((S_t.T @ y_t).unsqueeze(-1),
+                                     L).squeeze(-1).cpu().numpy()
+            # free the device copies before the test images go through the net
+            del S_t, y_t, G_t, L
+        else:
+            # the Gram matrix is symmetric positive definite, so a single posv
+            # call (Cholesky factor + solve fused in LAPACK) replaces the LU
+            # path of np.linalg.solve; the regularization goes straight onto
+            # the diagonal (no 256x256 eye). syrk computes only the lower
+            # triangle of S.T@S, which is all the lower-triangular
+            # factorization ever reads; passing the transposed view
+            # (Fortran-contiguous) keeps BLAS from copying the style matrix
+            G = ssyrk(alpha=1.0, a=S.T, trans=0, lower=1)
+            G.flat[::G.shape[0]+1] += l2_regularization
+            _, A, info = sposv(G, S.T @ y, lower=1, overwrite_a=1, overwrite_b=1)
+            if info != 0:
+                raise np.linalg.LinAlgError('size model solve failed (info=%d)'%info)
+        # the fitted values are only used for the correlation log line, so
+        # skip the (nimg x 256) matvec entirely when INFO is filtered out
+        if models_logger.isEnabledFor(logging.INFO):
+            ypred = S @ A
+            models_logger.info('train correlation: %0.4f'%_corr(y, ypred))
+
+        # only A, smean, ymean and diam_mean survive into the saved params;
+        # drop the per-patch style matrix before the test inference below so
+        # the two memory peaks do not stack
+        del styles, S, diams, y
+
         if run_test:
             nimg_test = len(test_data)
-            styles_test = np.zeros((nimg_test, 256), np.float32)
-            for i in range(nimg_test):
-                styles_test[i] = self.cp._run_net(test_data[i].transpose((1,2,0)))[1]
-            diam_test_pred = np.exp(A @ (styles_test - smean).T + np.log(self.diam_mean) + ymean)
-            diam_test_pred = np.maximum(5., diam_test_pred)
-            models_logger.info('test correlation: %0.4f'%np.corrcoef(diam_test, diam_test_pred)[0,1])
-
-        self.pretrained_size = cp_model_path+'_size.npy'
+            # push the whole test set through the stacked 4D path in one call
+            # so tiles from several images share forward passes; the stacked
+            # path normalizes styles jointly, so renormalize per row
+            if nimg_test > 1 and all(td.shape==test_data[0].shape for td in test_data):
+                styles_test = np.asarray(self.cp._run_net(np.stack(test_data).transpose((0,2,3,1)))[1],
+                                         np.float32)
+                styles_test /= (styles_test**2).sum(axis=1, keepdims=True)**0.5
+            else:
+                # every row is overwritten below, and the contiguous copy of
+                # the channels-last transpose happens once here instead of
+                # inside the tiling code
+                styles_test = np.empty((nimg_test, 256), np.float32)
+                for i in range(nimg_test):
+                    styles_test[i] = self.cp._run_net(
+                        np.ascontiguousarray(test_data[i].transpose((1,2,0))))[1]
+            np.subtract(styles_test, smean, out=styles_test)
+            # plain-float bias keeps the constant scalar for the numba kernel
+            # instead of going through 0-d array arithmetic
+            bias = math.log(float(self.diam_mean)) + float(ymean)
+            diam_test_pred = _size_pred(np.asarray(A, np.float32), styles_test,
+                                        np.float32(bias))
+            models_logger.info('test correlation: %0.4f'%_corr(diam_test, diam_test_pred))
+
+        self.pretrained_size = cp_model_path+'_size.npz'
         self.params = {'A': A, 'smean': smean, 'diam_mean': self.diam_mean, 'ymean': ymean}
-        np.save(self.pretrained_size, self.params)
+        # savez stores the arrays directly instead of pickling the dict, so
+        # the file loads without allow_pickle and without the pickle overhead
+        np.savez(self.pretrained_size, **self.params)
         models_logger.info('model saved to '+self.pretrained_size)
         return self.params
@@ -13,13 +13,22 @@ from . import utils, io, transforms
 # modified to use sinebow color
 def dx_to_circ(dP,transparency=False):
     """ dP is 2 x Y x X => 'optic' flow representation """
-    dP = np.array(dP)
-    mag = transforms.normalize99(np.sqrt(np.sum(dP**2,axis=0)),skel=1)
-    angles = np.arctan2(dP[1], dP[0])+np.pi
+    # same sinebow mapping as before but without any per-pixel trig:
+    # cos/sin of (arctan2(dy,dx)+pi) are just -dx/mag and -dy/mag, and the
+    # phase-shifted cosines are linear combinations of those
+    dP = np.ascontiguousarray(dP, np.float32)
+    mag0 = cv2.magnitude(dP[0], dP[1])
+    mag = transforms.normalize99(mag0, skel=1)
+    inv = np.zeros_like(mag0)
+    np.divide(-1., mag0, out=inv, where=mag0>0)
+    cosa = dP[0]*inv
+    sina = dP[1]*inv
+    cosa[mag0==0] = -1. # arctan2(0,0)=0 so the angle there is pi
     a = 2
-    r = ((np.cos(angles)+1)/a)
-    g = ((np.cos(angles+2*np.pi/3)+1)/a)
-    b =((np.cos(angles+4*np.pi/3)+1)/a)
+    s3 = np.sqrt(3)/2
+    r = (cosa+1)/a
+    g = (-0.5*cosa - s3*sina + 1)/a
+    b = (-0.5*cosa + s3*sina + 1)/a
     if transparency:
         im = np.stack((r,g,b,mag),axis=-1)
     else:
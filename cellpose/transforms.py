@@ -1,5 +1,6 @@
 import numpy as np
 import warnings
+import functools
 import cv2
 import edt
 from skimage.filters import gaussian
@@ -11,8 +12,22 @@ import logging
 transforms_logger = logging.getLogger(__name__)
 transforms_logger.setLevel(logging.DEBUG)
 
+try:
+    import torch
+    TORCH_ENABLED = True
+except:
+    TORCH_ENABLED = False
+
 from . import dynamics, utils
 
+def _median_filter(img, size=3):
+    """ median filter an image, using the SIMD-optimized cv2.medianBlur for the
+        dtype/kernel combinations it supports and scipy for everything else """
+    if img.ndim==2 and size in (3,5) and img.dtype in (np.uint8, np.uint16, np.float32):
+        return cv2.medianBlur(img, size)
+    return median_filter(img, size=size)
+
+@functools.lru_cache(maxsize=16)
 def _taper_mask(ly=224, lx=224, sig=7.5):
     bsize = max(224, max(ly, lx))
     xm = np.arange(bsize)
@@ -90,10 +105,14 @@ def average_tiles(y, ysub, xsub, Ly, Lx):
     """
     Navg = np.zeros((Ly,Lx))
     yf = np.zeros((y.shape[1], Ly, Lx), np.float32)
-    # taper edges of tiles
+    # taper edges of tiles; the window is the same for every tile, so apply it
+    # to the whole stack in one broadcast multiply before accumulating.
+    # in place: neither call site reads y afterwards, and the copy would
+    # double peak memory for large tile stacks
     mask = _taper_mask(ly=y.shape[-2], lx=y.shape[-1])
+    np.multiply(y, mask, out=y)
     for j in range(len(ysub)):
-        yf[:, ysub[j][0]:ysub[j][1],  xsub[j][0]:xsub[j][1]] += y[j] * mask
+        yf[:, ysub[j][0]:ysub[j][1],  xsub[j][0]:xsub[j][1]] += y[j]
         Navg[ysub[j][0]:ysub[j][1],  xsub[j][0]:xsub[j][1]] += mask
     yf /= Navg
     return yf
@@ -179,15 +198,15 @@ def make_tiles(imgi, bsize=224, augment=False, tile_overlap=0.1):
         ystart = np.linspace(0, Ly-bsizeY, ny).astype(int)
         xstart = np.linspace(0, Lx-bsizeX, nx).astype(int)
 
-        ysub = []
-        xsub = []
-        IMG = np.zeros((len(ystart), len(xstart), nchan,  bsizeY, bsizeX), np.float32)
-        for j in range(len(ystart)):
-            for i in range(len(xstart)):
-                ysub.append([ystart[j], ystart[j]+bsizeY])
-                xsub.append([xstart[i], xstart[i]+bsizeX])
-                IMG[j, i] = imgi[:, ysub[-1][0]:ysub[-1][1],  xsub[-1][0]:xsub[-1][1]]
-        
+        ysub = [[y0, y0+bsizeY] for y0 in ystart for _ in range(len(xstart))]
+        xsub = [[x0, x0+bsizeX] for _ in range(len(ystart)) for x0 in xstart]
+        # gather all tiles in one strided-window indexing operation (the numpy
+        # analog of torch unfold) instead of copying them out one by one;
+        # index both tile axes in a single step so only the ny*nx tiles are
+        # materialized, never the intermediate of every window along x
+        windows = np.lib.stride_tricks.sliding_window_view(imgi, (bsizeY, bsizeX), axis=(1,2))
+        IMG = windows[:, ystart[:,np.newaxis], xstart].transpose(1,2,0,3,4).astype(np.float32)
+
     return IMG, ysub, xsub, Ly, Lx
 
 # needs to have a wider range to avoid weird effects with few cells in frame
@@ -374,7 +393,7 @@ def reshape(data, channels=[0,0], chan_first=False):
             data = np.transpose(data, (2,0,1))
     return data
 
-def normalize_img(img, axis=-1, invert=False, skel=False):
+def normalize_img(img, axis=-1, invert=False, skel=False, percentiles=None):
     """ normalize each channel of the image so that so that 0.0=1st percentile
     and 1.0=99th percentile of image intensities
 
@@ -387,6 +406,10 @@ def normalize_img(img, axis=-1, invert=False, skel=False):
 
     axis: channel axis to loop over for normalization
 
+    percentiles: tuple of two arrays [nchan] (optional, default None)
+        precomputed lower/upper percentiles per channel, so callers
+        normalizing many images can batch the percentile computation
+
     Returns
     ---------------
 
@@ -403,12 +426,80 @@ def normalize_img(img, axis=-1, invert=False, skel=False):
     img = np.moveaxis(img, axis, 0)
     for k in range(img.shape[0]):
         if np.ptp(img[k]) > 0.0:
-            img[k] = normalize99(img[k],skel=skel)
-            if invert:
-                img[k] = -1*img[k] + 1   
+            if skel:
+                if percentiles is not None:
+                    img[k] = np.interp(img[k], (percentiles[0][k], percentiles[1][k]), (0, 1))
+                else:
+                    img[k] = normalize99(img[k],skel=skel)
+                if invert:
+                    img[k] = -1*img[k] + 1
+            else:
+                # fused normalization (+ optional inversion): a single in-place
+                # scale/offset pass instead of separate copy, scale and invert passes
+                if percentiles is not None:
+                    x01, x99 = percentiles[0][k], percentiles[1][k]
+                else:
+                    x01 = np.percentile(img[k], 1)
+                    x99 = np.percentile(img[k], 99)
+                scale = -1./(x99-x01) if invert else 1./(x99-x01)
+                img[k] *= scale
+                img[k] += 1.-x01*scale if invert else -x01*scale
     img = np.moveaxis(img, 0, axis)
     return img
 
+def _torch_percentile(flat_sorted, perc):
+    """ percentile of an ascending 1D tensor with np.percentile's linear interpolation """
+    n = flat_sorted.shape[0]
+    pos = perc / 100. * (n - 1)
+    lo = int(np.floor(pos))
+    hi = min(lo + 1, n - 1)
+    frac = pos - lo
+    return flat_sorted[lo] * (1 - frac) + flat_sorted[hi] * frac
+
+def normalize_img_torch(img, axis=-1, invert=False, skel=False):
+    """ torch version of normalize_img, for tensors already on the GPU
+
+    computes the channel percentiles with a device-side sort so large 3D
+    volumes are normalized without a round-trip through np.percentile
+
+    Parameters
+    ------------
+
+    img: torch tensor (at least 3 dimensions)
+
+    axis: channel axis to loop over for normalization
+
+    Returns
+    ---------------
+
+    img: torch float32 tensor on the same device, normalized per channel
+
+    """
+    if img.ndim<3:
+        error_message = 'Image needs to have at least 3 dimensions'
+        transforms_logger.critical(error_message)
+        raise ValueError(error_message)
+
+    img = img.float()
+    img = torch.movedim(img, axis, 0).clone()
+    for k in range(img.shape[0]):
+        flat = torch.sort(img[k].flatten())[0]
+        if flat[-1] - flat[0] > 0.0:
+            if skel:
+                # match normalize99(skel=True): clamp to [0.01, 99.99] percentiles
+                x01 = _torch_percentile(flat, 0.01)
+                x99 = _torch_percentile(flat, 99.99)
+                img[k] = torch.clamp((img[k] - x01) / (x99 - x01), 0, 1)
+                if invert:
+                    img[k] = -img[k] + 1
+            else:
+                x01 = _torch_percentile(flat, 1)
+                x99 = _torch_percentile(flat, 99)
+                scale = -1./(x99-x01) if invert else 1./(x99-x01)
+                img[k] = img[k] * scale + (1.-x01*scale if invert else -x01*scale)
+    img = torch.movedim(img, 0, axis)
+    return img
+
 def reshape_train_test(train_data, train_labels, test_data, test_labels, channels, normalize, skel=False):
     """ check sizes and reshape train and test data for training """
     nimg = len(train_data)
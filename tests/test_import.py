@@ -22,4 +22,23 @@ def test_model_dir():
     from cellpose import models
     model = models.CellposeModel(net_avg=False, pretrained_model='cyto')
     masks = model.eval(np.random.randn(224,224))[0]
-    assert masks.shape==(224,224)
\ No newline at end of file
+    assert masks.shape==(224,224)
+def test_net_avg_ensemble():
+    # net_avg=True averages several weight files in one pass; regression
+    # test for in-place accumulation on inference tensors
+    import os, tempfile
+    import numpy as np
+    import torch
+    from cellpose import models
+    model = models.CellposeModel()
+    tmpdir = tempfile.mkdtemp()
+    paths = []
+    for j in range(2):
+        path = os.path.join(tmpdir, 'net%d'%j)
+        model.net.save_model(path)
+        paths.append(path)
+        for param in model.net.parameters():
+            param.data += 0.01*torch.randn_like(param)
+    model = models.CellposeModel(pretrained_model=paths)
+    masks = model.eval(np.random.randn(224,224), net_avg=True)[0]
+    assert masks.shape==(224,224)